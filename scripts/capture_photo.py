@@ -4,28 +4,69 @@ WatchPot Photo Capture Script
 Captures photos at configured times with resilient error handling
 """
 
+import atexit
 import os
+import queue
+import re
+import signal
 import sys
+import shutil
 import subprocess
 import datetime
 import logging
+import logging.handlers
 import time
 from pathlib import Path
 
+# Resolve rpicam-still once per process instead of forking `which` per run
+_RPICAM_PATH = shutil.which('rpicam-still')
+
+# KEY=value lines; comment lines fail the anchor because '#' is not in
+# the keyword class, so no per-line startswith checks are needed
+_CONFIG_LINE_RE = re.compile(r'(?m)^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$')
+
+def _clean_config_value(value):
+    """Strip quotes or a trailing inline comment from a config value
+
+    Quoted values keep their content verbatim (templates may contain '#');
+    unquoted ones drop anything after '#' so call sites never re-strip."""
+    if value[:1] in ('"', "'"):
+        return value.strip('"\'')
+    return value.split('#', 1)[0].rstrip()
+
 def setup_logging(log_level='INFO'):
     """Setup logging with proper error handling"""
     log_dir = Path('logs')
     log_dir.mkdir(parents=True, exist_ok=True)
-    
+
+    root = logging.getLogger()
+    if root.handlers:
+        return logging.getLogger(__name__)
+
     level = getattr(logging, log_level.upper(), logging.INFO)
-    logging.basicConfig(
-        level=level,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_dir / 'capture.log'),
-            logging.StreamHandler()
-        ]
-    )
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    # delay=True defers the open() until the first record, so runs that
+    # log nothing never touch the file; rotation keeps the log bounded
+    # without an external logrotate job
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_dir / 'capture.log', maxBytes=1 << 20, backupCount=3, delay=True)
+    file_handler.setFormatter(formatter)
+
+    # File writes happen on a listener thread so a slow SD card never
+    # stalls the capture/retry loop; stop() at exit flushes the queue
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.addHandler(stream_handler)
     return logging.getLogger(__name__)
 
 def load_config(config_file):
@@ -43,27 +84,85 @@ def load_config(config_file):
     }
     
     try:
-        with open(config_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip().lower()
-                    value = value.strip().strip('"\'')
-                    config[key] = value
+        for key, value in _CONFIG_LINE_RE.findall(Path(config_file).read_text()):
+            config[key.lower()] = _clean_config_value(value)
     except Exception as e:
         print(f"Warning: Could not load config file {config_file}: {e}")
         print("Using default configuration")
-    
+
+    config['_photo_minutes'] = build_schedule_lookup(config.get('photo_times', ''))
     return config
 
-def check_prerequisites():
+def build_schedule_lookup(photo_times, window_minutes=5):
+    """Map each minute of day inside a capture window to its HHMM suffix"""
+    lookup = {}
+    for scheduled_time in photo_times.split(','):
+        scheduled_time = scheduled_time.strip()
+        if not scheduled_time:
+            continue
+
+        try:
+            hour, minute = map(int, scheduled_time.split(':'))
+        except ValueError:
+            continue
+
+        base = hour * 60 + minute
+        suffix = f"{hour:02d}{minute:02d}"
+        for delta in range(-window_minutes, window_minutes + 1):
+            lookup.setdefault((base + delta) % 1440, suffix)
+
+    return lookup
+
+def check_prerequisites(config):
     """Check if camera and required tools are available"""
-    if not subprocess.run(['which', 'rpicam-still'], capture_output=True).returncode == 0:
+    if config.get('camera_backend', 'rpicam') == 'picamera2':
+        try:
+            import picamera2  # noqa: F401
+            return True
+        except ImportError:
+            print("Error: picamera2 not found. Install with: sudo apt install python3-picamera2")
+            return False
+
+    if _RPICAM_PATH is None:
         print("Error: rpicam-still not found. Install with: sudo apt install camera-apps")
         return False
     return True
 
+# Camera kept open for the lifetime of the process so repeated captures
+# (retries, multi-shot runs) skip the 5-7 s sensor configuration cost
+# that a fresh rpicam-still pays on every invocation
+_picamera2_camera = None
+
+def capture_with_picamera2(config, photo_path, logger):
+    """Capture in-process via picamera2, reusing the configured camera"""
+    global _picamera2_camera
+
+    try:
+        from picamera2 import Picamera2
+
+        if _picamera2_camera is None:
+            camera = Picamera2()
+            size = (int(config['photo_width']), int(config['photo_height']))
+            camera.configure(camera.create_still_configuration(main={'size': size}))
+            camera.start()
+            _picamera2_camera = camera
+
+        _picamera2_camera.capture_file(str(photo_path))
+        return True
+    except Exception as e:
+        logger.warning(f"picamera2 capture failed: {e}")
+        return False
+
+def close_camera():
+    """Release the persistent picamera2 camera, if one was opened"""
+    global _picamera2_camera
+    if _picamera2_camera is not None:
+        try:
+            _picamera2_camera.close()
+        except Exception:
+            pass
+        _picamera2_camera = None
+
 def capture_single_photo(config, time_suffix, logger):
     """Capture a single photo with retry logic"""
     max_retries = int(config.get('max_retries', '3'))
@@ -83,35 +182,54 @@ def capture_single_photo(config, time_suffix, logger):
             filename = f"watchpot_{today.strftime('%Y%m%d')}_{time_suffix}.jpg"
             photo_path = daily_dir / filename
             
-            # Build capture command
-            cmd = [
-                'rpicam-still',
-                '-o', str(photo_path),
-                '--width', config['photo_width'],
-                '--height', config['photo_height'],
-                '--quality', config['photo_quality'],
-                '--immediate',
-                '--nopreview',
-                '--timeout', '10000',
-                '--saturation', config.get('camera_saturation', '0.8'),
-                '--gain', config.get('camera_gain', '1.0'),
-                '--contrast', config.get('camera_contrast', '1.0'),
-                '--brightness', config.get('camera_brightness', '0.0'),
-                '--sharpness', config.get('camera_sharpness', '1.0')
-            ]
-            
-            # Add AWB settings (manual gains override AWB mode for NoIR cameras)
-            if 'camera_awbgains' in config and config['camera_awbgains'].strip():
-                cmd.extend(['--awbgains', config['camera_awbgains']])
-            else:
-                cmd.extend(['--awb', config.get('camera_awb', 'auto')])
-            
             logger.info(f"Attempt {attempt + 1}/{max_retries}: Capturing {filename}")
-            
-            # Execute capture with timeout
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            
-            if result.returncode == 0:
+
+            if config.get('camera_backend', 'rpicam') == 'picamera2':
+                capture_ok = capture_with_picamera2(config, photo_path, logger)
+            else:
+                # Build capture command
+                cmd = [
+                    _RPICAM_PATH,
+                    '-o', str(photo_path),
+                    '--width', config['photo_width'],
+                    '--height', config['photo_height'],
+                    '--quality', config['photo_quality'],
+                    '--immediate',
+                    '--nopreview',
+                    '--timeout', '10000',
+                    '--saturation', config.get('camera_saturation', '0.8'),
+                    '--gain', config.get('camera_gain', '1.0'),
+                    '--contrast', config.get('camera_contrast', '1.0'),
+                    '--brightness', config.get('camera_brightness', '0.0'),
+                    '--sharpness', config.get('camera_sharpness', '1.0')
+                ]
+
+                # Add AWB settings (manual gains override AWB mode for NoIR cameras)
+                if 'camera_awbgains' in config and config['camera_awbgains'].strip():
+                    cmd.extend(['--awbgains', config['camera_awbgains']])
+                else:
+                    cmd.extend(['--awb', config.get('camera_awb', 'auto')])
+
+                # Execute capture with timeout; stdout is discarded and
+                # stderr stays as bytes, decoded only on failure. The
+                # subprocess gets its own session so a hung pipeline can
+                # be killed as a whole process group
+                proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=True)
+                try:
+                    _, stderr_data = proc.communicate(timeout=60)
+                except subprocess.TimeoutExpired:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+                    raise
+
+                capture_ok = proc.returncode == 0
+                if not capture_ok:
+                    stderr = stderr_data.decode('utf-8', 'replace')
+                    logger.warning(f"rpicam-still failed (attempt {attempt + 1}): {stderr}")
+
+            if capture_ok:
                 if photo_path.exists() and photo_path.stat().st_size > 1024:
                     file_size = photo_path.stat().st_size
                     logger.info(f"Photo captured successfully: {filename} ({file_size} bytes)")
@@ -120,9 +238,7 @@ def capture_single_photo(config, time_suffix, logger):
                     logger.warning(f"Photo file is empty or too small: {filename}")
                     if photo_path.exists():
                         photo_path.unlink()
-            else:
-                logger.warning(f"rpicam-still failed (attempt {attempt + 1}): {result.stderr}")
-            
+
             if attempt < max_retries - 1:
                 logger.info(f"Retrying in {retry_delay} seconds...")
                 time.sleep(retry_delay)
@@ -138,30 +254,48 @@ def capture_single_photo(config, time_suffix, logger):
     logger.error(f"Failed to capture photo after {max_retries} attempts")
     return None
 
-def cleanup_old_photos(config, logger):
+def cleanup_old_photos(config, logger, force=False):
     """Remove old photos based on retention policy"""
     try:
         retention_days = int(config.get('retention_days', '7'))
         photos_dir = Path(config['photos_dir'])
-        
+
         if not photos_dir.exists():
             return
-        
-        cutoff_date = datetime.date.today() - datetime.timedelta(days=retention_days)
-        
-        for daily_dir in photos_dir.glob("daily_*"):
+
+        # Skip the directory walk when nothing changed since the last
+        # cleanup; a new daily dir bumps the mtime, so stale entries are
+        # reconsidered at least once per capture day
+        marker = photos_dir / '.last_cleanup'
+        if not force:
             try:
-                dir_date_str = daily_dir.name.replace('daily_', '')
-                dir_date = datetime.datetime.strptime(dir_date_str, '%Y%m%d').date()
-                
+                if float(marker.read_text()) == photos_dir.stat().st_mtime:
+                    logger.debug("Photos directory unchanged, skipping cleanup")
+                    return
+            except (OSError, ValueError):
+                pass
+
+        cutoff_date = datetime.date.today() - datetime.timedelta(days=retention_days)
+
+        # Single scandir pass instead of glob + per-entry Path objects
+        with os.scandir(photos_dir) as it:
+            for entry in it:
+                if not (entry.is_dir() and entry.name.startswith('daily_')):
+                    continue
+                try:
+                    dir_date = datetime.datetime.strptime(entry.name[6:], '%Y%m%d').date()
+                except ValueError:
+                    continue
+
                 if dir_date < cutoff_date:
-                    logger.info(f"Removing old photo directory: {daily_dir}")
-                    import shutil
-                    shutil.rmtree(daily_dir)
-                    
-            except ValueError:
-                continue
-                
+                    logger.info(f"Removing old photo directory: {entry.path}")
+                    shutil.rmtree(entry.path)
+
+        # Touch first so creating the marker bumps the directory mtime
+        # before we record it; rewriting an existing file does not
+        marker.touch()
+        marker.write_text(str(photos_dir.stat().st_mtime))
+
     except Exception as e:
         logger.error(f"Error during cleanup: {e}")
 
@@ -173,35 +307,23 @@ def get_today_photos(config):
     
     if not daily_dir.exists():
         return []
-    
-    photos = list(daily_dir.glob("*.jpg"))
+
+    with os.scandir(daily_dir) as it:
+        photos = [entry.path for entry in it
+                  if entry.is_file() and entry.name.endswith('.jpg')]
     photos.sort()
-    return [str(p) for p in photos]
+    return photos
 
 def should_capture_now(config):
     """Check if we should capture a photo now based on schedule"""
-    photo_times = config.get('photo_times', '').split(',')
-    current_dt = datetime.datetime.now()
-    
-    # Allow 5 minutes window for each scheduled time
-    for scheduled_time in photo_times:
-        scheduled_time = scheduled_time.strip()
-        if not scheduled_time:
-            continue
-            
-        try:
-            hour, minute = map(int, scheduled_time.split(':'))
-            scheduled_dt = current_dt.replace(hour=hour, minute=minute, second=0, microsecond=0)
-            
-            # Check if current time is within 5 minutes of scheduled time
-            time_diff = abs((current_dt - scheduled_dt).total_seconds())
-            if time_diff <= 300:  # 5 minutes
-                return scheduled_time.replace(':', '')
-                
-        except ValueError:
-            continue
-    
-    return None
+    lookup = config.get('_photo_minutes')
+    if lookup is None:
+        lookup = build_schedule_lookup(config.get('photo_times', ''))
+
+    # The 5-minute windows are baked into the lookup, so the check is a
+    # single dict probe instead of per-entry datetime arithmetic
+    now = datetime.datetime.now()
+    return lookup.get(now.hour * 60 + now.minute)
 
 def main():
     import argparse
@@ -222,7 +344,7 @@ def main():
     # Handle different modes
     if args.cleanup:
         logger.info("Running photo cleanup")
-        cleanup_old_photos(config, logger)
+        cleanup_old_photos(config, logger, force=True)
         return
     
     if args.list:
@@ -236,7 +358,7 @@ def main():
         return
     
     # Check prerequisites
-    if not check_prerequisites():
+    if not check_prerequisites(config):
         sys.exit(1)
     
     # Determine time suffix
@@ -255,8 +377,11 @@ def main():
     logger.info(f"Starting photo capture for time: {time_suffix}")
     
     # Capture photo
-    photo_path = capture_single_photo(config, time_suffix, logger)
-    
+    try:
+        photo_path = capture_single_photo(config, time_suffix, logger)
+    finally:
+        close_camera()
+
     if photo_path:
         logger.info("Photo capture completed successfully")
         
@@ -4,23 +4,44 @@ WatchPot Email Sender Script
 Sends daily email with all photos and system stats
 """
 
+import atexit
+import base64
+import io
+import json
 import os
+import re
 import sys
-import smtplib
 import logging
+import logging.handlers
 import mimetypes
+import mmap
+import shutil
 import socket
-import requests
 import datetime
-import platform
-import psutil
+import functools
 import subprocess
+import tempfile
+import threading
 import time
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from pathlib import Path
 
+# smtplib and the email.* machinery are imported inside the send path:
+# the frequent cron wakeups that fail the schedule gate never touch them
+
+# requests and psutil together cost hundreds of ms of import time on a
+# Pi; load them lazily so runs that exit early (not scheduled) skip it
+_psutil = None
+
+def _get_psutil():
+    """Import psutil on first use and seed its CPU counter so later
+    cpu_percent(interval=None) calls return a delta without sleeping"""
+    global _psutil
+    if _psutil is None:
+        import psutil
+        psutil.cpu_percent(interval=None)
+        _psutil = psutil
+    return _psutil
+
 def setup_logging(config):
     """Setup logging"""
     log_dir = Path('logs')
@@ -32,56 +53,280 @@ def setup_logging(config):
         level=level,
         format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[
-            logging.FileHandler(log_dir / 'email.log'),
+            # delay=True defers the open() until the first record, so
+            # runs that log nothing never touch the file; rotation keeps
+            # the log bounded without an external logrotate job
+            logging.handlers.RotatingFileHandler(
+                log_dir / 'email.log', maxBytes=1 << 20, backupCount=3,
+                delay=True),
             logging.StreamHandler()
         ]
     )
     return logging.getLogger(__name__)
 
+# KEY=value lines; comment lines fail the anchor because '#' is not in
+# the keyword class, so no per-line startswith checks are needed
+_CONFIG_LINE_RE = re.compile(r'(?m)^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$')
+
+def _parse_recipients(raw):
+    """Split the comma-separated RECIPIENTS value into a clean list"""
+    return [r.strip() for r in raw.split(',') if r.strip()]
+
+def _clean_config_value(value):
+    """Strip quotes or a trailing inline comment from a config value
+
+    Quoted values keep their content verbatim (templates may contain '#');
+    unquoted ones drop anything after '#' so call sites never re-strip."""
+    if value[:1] in ('"', "'"):
+        return value.strip('"\'')
+    return value.split('#', 1)[0].rstrip()
+
 def load_config(config_file):
     """Load configuration"""
     config = {}
     try:
-        with open(config_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip().lower()
-                    value = value.strip().strip('"\'')
-                    config[key] = value
+        for key, value in _CONFIG_LINE_RE.findall(Path(config_file).read_text()):
+            config[key.lower()] = _clean_config_value(value)
+        config['_email_minutes'] = build_send_lookup(config.get('email_time', '19:00'))
+        if 'recipients' in config:
+            config['_recipients'] = _parse_recipients(config['recipients'])
         return config
     except Exception as e:
         print(f"Error loading config: {e}")
         sys.exit(1)
 
-def get_system_stats():
+# Public IP cache: the address rarely changes between runs, so one lookup
+# per TTL window replaces a DNS + TLS round-trip on every email
+PUBLIC_IP_CACHE = Path('logs') / 'public_ip.cache'
+PUBLIC_IP_TTL = 3600  # seconds
+
+_http_session = None
+
+def _get_http_session():
+    """Module-level requests.Session so TLS session state is reused"""
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _http_session = requests.Session()
+        # One pooled keep-alive connection is plenty; retries are ours
+        _http_session.mount('https://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=2, max_retries=0))
+    return _http_session
+
+# Public STUN server used for the cheap UDP lookup path
+STUN_SERVER = ('stun.l.google.com', 19302)
+STUN_MAGIC_COOKIE = 0x2112A442
+
+def get_stun_public_ip(server=STUN_SERVER, timeout=2):
+    """Resolve the public IP with a single UDP STUN binding round-trip"""
+    import struct
+
+    txn_id = os.urandom(12)
+    request = struct.pack('>HHI', 0x0001, 0, STUN_MAGIC_COOKIE) + txn_id
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto(request, server)
+        data, _ = sock.recvfrom(1024)
+    finally:
+        sock.close()
+
+    # Binding success response with our transaction id
+    if len(data) < 20 or data[0:2] != b'\x01\x01' or data[8:20] != txn_id:
+        return None
+
+    msg_len = struct.unpack('>H', data[2:4])[0]
+    pos, end = 20, min(len(data), 20 + msg_len)
+    while pos + 4 <= end:
+        attr_type, attr_len = struct.unpack('>HH', data[pos:pos + 4])
+        value = data[pos + 4:pos + 4 + attr_len]
+        if attr_type == 0x0020 and len(value) >= 8 and value[1] == 0x01:
+            # XOR-MAPPED-ADDRESS (IPv4): address is XORed with the cookie
+            addr = struct.unpack('>I', value[4:8])[0] ^ STUN_MAGIC_COOKIE
+            return socket.inet_ntoa(struct.pack('>I', addr))
+        if attr_type == 0x0001 and len(value) >= 8 and value[1] == 0x01:
+            # Plain MAPPED-ADDRESS fallback
+            return socket.inet_ntoa(value[4:8])
+        pos += 4 + attr_len + ((4 - attr_len % 4) % 4)
+
+    return None
+
+def get_public_ip(ttl=PUBLIC_IP_TTL):
+    """Get public IP with retry logic, cached on disk with a TTL"""
+    try:
+        if time.time() - PUBLIC_IP_CACHE.stat().st_mtime < ttl:
+            cached = PUBLIC_IP_CACHE.read_text().strip()
+            if cached:
+                return cached
+    except OSError:
+        pass
+
+    # One UDP packet beats a DNS + TLS + HTTP round-trip when it works
+    try:
+        ip = get_stun_public_ip()
+        if ip:
+            save_public_ip_cache(ip)
+            return ip
+    except OSError:
+        pass
+
+    for attempt in range(3):
+        try:
+            # Split timeout: fail fast on connect, allow a slower read
+            response = _get_http_session().get('https://api.ipify.org', timeout=(3, 5))
+            ip = response.text.strip()
+            if ip:
+                save_public_ip_cache(ip)
+                return ip
+        except:
+            pass
+        if attempt < 2:
+            time.sleep(5)
+
+    return 'Unknown'
+
+def save_public_ip_cache(ip):
+    """Write the public IP cache atomically (tempfile + rename)"""
+    try:
+        PUBLIC_IP_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(PUBLIC_IP_CACHE.parent))
+        with os.fdopen(fd, 'w') as f:
+            f.write(ip)
+        os.replace(tmp_path, str(PUBLIC_IP_CACHE))
+    except OSError:
+        pass
+
+# Boot time cannot change while we are running, so one syscall suffices
+_boot_time = None
+
+def _get_boot_time():
+    global _boot_time
+    if _boot_time is None:
+        _boot_time = datetime.datetime.fromtimestamp(_get_psutil().boot_time())
+    return _boot_time
+
+# Thermal source is resolved once per process: the sysfs fd stays open
+# across reads and the vcgencmd probe happens at most once, so a missing
+# source never costs a fork+exec per call
+THERMAL_SYSFS_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+_thermal_fd = -1
+_thermal_probed = False
+_vcgencmd_path = None
+
+def get_cpu_temperature():
+    """Read the CPU temperature, caching the chosen source"""
+    global _thermal_fd, _thermal_probed, _vcgencmd_path
+
+    if not _thermal_probed:
+        _thermal_probed = True
+        try:
+            # Raw fd + pread: no buffered-IO layer, no seek, no text decode
+            _thermal_fd = os.open(THERMAL_SYSFS_PATH, os.O_RDONLY)
+            atexit.register(os.close, _thermal_fd)
+        except OSError:
+            _vcgencmd_path = shutil.which('vcgencmd')
+
+    if _thermal_fd >= 0:
+        try:
+            return f"{int(os.pread(_thermal_fd, 16, 0)) / 1000.0:.1f}°C"
+        except (OSError, ValueError):
+            pass
+
+    if _vcgencmd_path:
+        try:
+            result = subprocess.run([_vcgencmd_path, 'measure_temp'],
+                                    capture_output=True, text=True, timeout=5)
+            if result.returncode == 0:
+                return result.stdout.strip().replace('temp=', '')
+        except Exception:
+            pass
+
+    return 'Unknown'
+
+def _linux_ipv4_ifaces():
+    """List 'iface: ipv4' strings with one SIOCGIFADDR ioctl per interface.
+
+    Far lighter than psutil.net_if_addrs(), which traverses every address
+    family of every interface; interfaces without an IPv4 address (down,
+    unconfigured) fail the ioctl and are skipped."""
+    import fcntl
+    import struct
+
+    SIOCGIFADDR = 0x8915
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _index, name in socket.if_nameindex():
+            try:
+                packed = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                                     struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                continue
+            ip = socket.inet_ntoa(packed[20:24])
+            if ip != '127.0.0.1':
+                interfaces.append(f"{name}: {ip}")
+    return interfaces
+
+def _list_ipv4_interfaces(psutil):
+    """Non-loopback IPv4 interfaces; ioctl fast path, psutil fallback"""
+    try:
+        return _linux_ipv4_ifaces()
+    except Exception:
+        pass
+
+    # Non-Linux platforms (or odd ioctl failures): walk psutil's listing,
+    # skipping interfaces that are down and stopping at the first IPv4
+    try:
+        if_up = psutil.net_if_stats()
+        interfaces = []
+        for interface, addrs in psutil.net_if_addrs().items():
+            if interface in if_up and not if_up[interface].isup:
+                continue
+            for addr in addrs:
+                if addr.family == socket.AF_INET and addr.address != '127.0.0.1':
+                    interfaces.append(f"{interface}: {addr.address}")
+                    break
+        return interfaces
+    except:
+        return []
+
+def get_system_stats(config=None, now=None):
     """Get comprehensive system information with retry logic"""
+    import platform
+
+    # Import (and seed) psutil before the IP lookup so the CPU counter
+    # accumulates over the network round-trip instead of a zero window
+    psutil = _get_psutil()
+
+    now = now or datetime.datetime.now()
     stats = {
         'hostname': socket.gethostname(),
         'platform': platform.platform(),
-        'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        'timestamp': now.strftime('%Y-%m-%d %H:%M:%S')
     }
-    
-    # Network info with retry
-    for attempt in range(3):
-        try:
-            response = requests.get('https://api.ipify.org', timeout=10)
-            stats['public_ip'] = response.text.strip()
-            break
-        except:
-            if attempt == 2:
-                stats['public_ip'] = 'Unknown'
-            time.sleep(5) 
-    
-    # System health
+
+    # Run the public-IP lookup in the background so its network
+    # round-trips (and retry backoffs) overlap with the local reads below
     try:
-        stats['cpu_percent'] = f"{psutil.cpu_percent(interval=1):.1f}%"
+        ip_ttl = int(config.get('public_ip_cache_ttl', PUBLIC_IP_TTL)) if config else PUBLIC_IP_TTL
+    except ValueError:
+        ip_ttl = PUBLIC_IP_TTL
+    ip_result = {}
+    ip_thread = threading.Thread(
+        target=lambda: ip_result.update(ip=get_public_ip(ip_ttl)), daemon=True)
+    ip_thread.start()
+
+    # System health (cpu_percent uses the counter seeded at import,
+    # so it returns immediately instead of sleeping for a sample window)
+    try:
+        stats['cpu_percent'] = f"{psutil.cpu_percent(interval=None):.1f}%"
         stats['memory_percent'] = f"{psutil.virtual_memory().percent:.1f}%"
         stats['disk_percent'] = f"{psutil.disk_usage('/').percent:.1f}%"
-        
-        boot_time = datetime.datetime.fromtimestamp(psutil.boot_time())
-        uptime = datetime.datetime.now() - boot_time
+
+        boot_time = _get_boot_time()
+        uptime = now - boot_time
         stats['boot_time'] = boot_time.strftime('%Y-%m-%d %H:%M:%S')
         stats['uptime'] = str(uptime).split('.')[0]
     except Exception as e:
@@ -92,79 +337,90 @@ def get_system_stats():
         stats['uptime'] = 'Unknown'
     
     # CPU temperature (Raspberry Pi)
-    try:
-        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-            temp = int(f.read()) / 1000.0
-            stats['cpu_temperature'] = f"{temp:.1f}°C"
-    except:
+    stats['cpu_temperature'] = get_cpu_temperature()
+
+    # Photos volume usage, only when it's a separate mount from /
+    if config:
+        photos_dir = config.get('photos_dir', 'photos')
         try:
-            result = subprocess.run(['vcgencmd', 'measure_temp'], 
-                                  capture_output=True, text=True, timeout=5)
-            if result.returncode == 0:
-                stats['cpu_temperature'] = result.stdout.strip().replace('temp=', '')
-            else:
-                stats['cpu_temperature'] = 'Unknown'
-        except:
-            stats['cpu_temperature'] = 'Unknown'
-    
-    # Network interfaces
-    try:
-        interfaces = []
-        for interface, addrs in psutil.net_if_addrs().items():
-            for addr in addrs:
-                if addr.family == socket.AF_INET and addr.address != '127.0.0.1':
-                    interfaces.append(f"{interface}: {addr.address}")
-        stats['network_interfaces'] = interfaces
-    except:
-        stats['network_interfaces'] = []
-    
+            if os.stat(photos_dir).st_dev != os.stat('/').st_dev:
+                stats['photos_disk_percent'] = f"{psutil.disk_usage(photos_dir).percent:.1f}%"
+        except Exception:
+            pass
+
+    stats['network_interfaces'] = _list_ipv4_interfaces(psutil)
+
+    # Wait out the lookup only after all the cheap local work is done;
+    # the timeout covers get_public_ip's worst-case retry schedule
+    ip_thread.join(timeout=30)
+    stats['public_ip'] = ip_result.get('ip', 'Unknown')
+
     return stats
 
-def get_today_photos(photos_dir):
-    """Get all photos from today"""
-    today = datetime.date.today()
-    daily_dir = Path(photos_dir) / f"daily_{today.strftime('%Y%m%d')}"
-    
-    if not daily_dir.exists():
-        return []
-    
-    photos = list(daily_dir.glob("*.jpg"))
+@functools.lru_cache(maxsize=4)
+def _scan_daily_dir(daily_dir, mtime_ns):
+    """List the JPEGs of one daily dir in a single scandir pass.
+
+    Keyed by (path, mtime_ns): repeated calls within a run reuse the
+    listing, and the cache self-invalidates when a new photo lands."""
+    with os.scandir(daily_dir) as it:
+        photos = [entry.path for entry in it
+                  if entry.is_file() and entry.name.endswith('.jpg')]
     photos.sort()
-    return [str(p) for p in photos]
+    return tuple(photos)
+
+def daily_dir_for(photos_dir, date=None):
+    """Path of the per-day photo directory.
+
+    Callers compute this once per run and pass it around, so a run that
+    straddles midnight keeps operating on a single consistent day."""
+    date = date or datetime.date.today()
+    return Path(photos_dir) / f"daily_{date.strftime('%Y%m%d')}"
 
-def get_sent_photos_file(photos_dir):
+def get_today_photos(daily_dir):
+    """Get all photos from the given daily directory"""
+    try:
+        mtime_ns = daily_dir.stat().st_mtime_ns
+    except OSError:
+        return []
+
+    return list(_scan_daily_dir(str(daily_dir), mtime_ns))
+
+def get_sent_photos_file(daily_dir):
     """Get path to file tracking sent photos"""
-    today = datetime.date.today()
-    daily_dir = Path(photos_dir) / f"daily_{today.strftime('%Y%m%d')}"
-    return daily_dir / ".sent_photos"
-
-def load_sent_photos(photos_dir):
-    """Load list of photos already sent"""
-    sent_file = get_sent_photos_file(photos_dir)
-    if sent_file.exists():
-        try:
-            with open(sent_file, 'r') as f:
-                return [line.strip() for line in f if line.strip()]
-        except:
-            return []
-    return []
+    return daily_dir / ".sent_photos.json"
+
+def load_sent_photos(daily_dir):
+    """Load set of photos already sent"""
+    sent_file = get_sent_photos_file(daily_dir)
+    try:
+        return set(json.loads(sent_file.read_text()))
+    except (OSError, ValueError):
+        pass
+
+    # Migrate from the old line-per-filename format if it is present
+    legacy_file = sent_file.with_name('.sent_photos')
+    try:
+        return {line.strip() for line in legacy_file.read_text().splitlines()
+                if line.strip()}
+    except OSError:
+        return set()
 
-def save_sent_photos(photos_dir, sent_photos):
-    """Save list of photos already sent"""
-    sent_file = get_sent_photos_file(photos_dir)
+def save_sent_photos(daily_dir, sent_photos):
+    """Save set of photos already sent as single-line JSON"""
+    sent_file = get_sent_photos_file(daily_dir)
     sent_file.parent.mkdir(parents=True, exist_ok=True)
     with open(sent_file, 'w') as f:
-        for photo in sent_photos:
-            f.write(f"{photo}\n")
+        json.dump(sorted(set(sent_photos)), f)
 
-def get_photos_to_send(photos_dir, incremental=False):
+def get_photos_to_send(daily_dir, incremental=False):
     """Get photos to send, optionally filtering out already sent ones"""
-    all_photos = get_today_photos(photos_dir)
-    
+    all_photos = get_today_photos(daily_dir)
+
     if not incremental:
         return all_photos
-    
-    sent_photos = load_sent_photos(photos_dir)
+
+    sent_photos = load_sent_photos(daily_dir)
     new_photos = [p for p in all_photos if os.path.basename(p) not in sent_photos]
     return new_photos
 
@@ -185,92 +441,314 @@ def select_single_photo(photo_paths, selection_method='last'):
     else:
         return photo_paths[-1]  # Default to last
 
-def create_gif_from_photos(photo_paths, output_path, max_size_mb=20, config=None, logger=None):
-    """Create an animated GIF directly from photos"""
-    if not photo_paths:
+def _gif_filter_chain(gif_width, gif_height):
+    """ffmpeg scale + center crop (shifted up slightly for plant
+    monitoring), matching the old ImageMagick -resize/-extent geometry"""
+    return (f"scale={gif_width}:{gif_height}:force_original_aspect_ratio=increase,"
+            f"crop={gif_width}:{gif_height}:(iw-{gif_width})/2:"
+            f"(ih-{gif_height})/2-{gif_height}/18")
+
+def _ensure_scaled(src_path, cache_dir, gif_width, gif_height):
+    """Scale one photo into the cache unless a fresh copy is already there"""
+    dst = cache_dir / os.path.basename(src_path)
+    try:
+        if dst.stat().st_mtime_ns >= os.stat(src_path).st_mtime_ns:
+            return str(dst)
+    except OSError:
+        pass
+
+    if shutil.which('ffmpeg'):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', str(src_path),
+               '-vf', _gif_filter_chain(gif_width, gif_height), str(dst)]
+    else:
+        cmd = ['convert', str(src_path),
+               '-resize', f'{gif_width}x{gif_height}^',
+               '-gravity', 'center',
+               '-extent', f'{gif_width}x{gif_height}+0-{gif_height//18}',
+               str(dst)]
+
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    return str(dst) if result.returncode == 0 else None
+
+def _prescale_photos(photo_paths, gif_width, gif_height, logger):
+    """Scale photos into daily_dir/.scaled/{w}x{h}/, reusing earlier runs.
+
+    Frames are immutable once captured, so a cached scaled copy keyed by
+    source mtime never needs redoing: re-runs (and the two decode passes
+    of the GIF encoder) only pay for photos that are new. Returns None if
+    any frame fails, in which case callers fall back to the originals.
+    The cache lives inside the daily dir and is removed with it by the
+    normal retention cleanup."""
+    cache_dir = Path(photo_paths[0]).parent / '.scaled' / f'{gif_width}x{gif_height}'
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
         return None
-    
+
+    # Each job is a subprocess, so threads are enough to overlap them
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as pool:
+        scaled = list(pool.map(
+            lambda p: _ensure_scaled(p, cache_dir, gif_width, gif_height),
+            photo_paths))
+
+    if None in scaled:
+        if logger:
+            logger.warning("Pre-scaling failed, encoding from original photos")
+        return None
+    return scaled
+
+def _create_gif_ffmpeg(photo_paths, output_path, gif_delay, gif_width, gif_height,
+                       logger, pre_scaled=False):
+    """Two-pass ffmpeg GIF encode: palettegen then paletteuse.
+
+    ffmpeg decodes JPEGs with multithreaded SIMD code and computes one
+    shared palette, which is both faster and much smaller output than
+    ImageMagick's per-frame quantization."""
+    duration = gif_delay / 100.0  # ImageMagick delay unit is 1/100 s
+    filters = 'null' if pre_scaled else _gif_filter_chain(gif_width, gif_height)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # concat demuxer list so arbitrary photo selections work (a glob
+        # pattern would drag in every JPEG of the directory)
+        list_path = os.path.join(tmp_dir, 'frames.txt')
+        with open(list_path, 'w') as f:
+            for path in photo_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+                f.write(f"duration {duration}\n")
+
+        palette_path = os.path.join(tmp_dir, 'palette.png')
+        pass1 = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-vf', f'{filters},palettegen=stats_mode=diff',
+            palette_path
+        ]
+        result = subprocess.run(pass1, capture_output=True, text=True)
+        if result.returncode != 0:
+            if logger:
+                logger.error(f"ffmpeg palettegen failed: {result.stderr}")
+            return False
+
+        pass2 = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-i', palette_path,
+            '-lavfi', f'{filters}[x];[x][1:v]paletteuse=dither=bayer',
+            '-loop', '0',
+            str(output_path)
+        ]
+        result = subprocess.run(pass2, capture_output=True, text=True)
+        if result.returncode != 0:
+            if logger:
+                logger.error(f"ffmpeg paletteuse failed: {result.stderr}")
+            return False
+
+    return True
+
+# convert's -layers optimize is the slowest (single-threaded) part of
+# the ImageMagick pipeline; gifsicle -O3 optimizes an assembled GIF
+# faster and smaller, so prefer it when installed
+_GIFSICLE_PATH = shutil.which('gifsicle')
+
+def _create_gif_convert(photo_paths, output_path, gif_delay, gif_width, gif_height,
+                        logger, pre_scaled=False):
+    """Fallback ImageMagick GIF encode, post-optimized by gifsicle if present"""
+    unoptimized = None
     try:
-        import subprocess
-        
-        # Get GIF settings from config or use defaults
-        gif_delay_raw = config.get('gif_delay', '50') if config else '50'
-        gif_width_raw = config.get('gif_width', '1920') if config else '1920'
-        gif_height_raw = config.get('gif_height', '1080') if config else '1080'
-        
-        gif_delay = int(gif_delay_raw.split('#')[0].strip())
-        gif_width = int(gif_width_raw.split('#')[0].strip())
-        gif_height = int(gif_height_raw.split('#')[0].strip())
-        
-        # Create GIF with center crop shifted up slightly for plant monitoring
+        if _GIFSICLE_PATH:
+            fd, unoptimized = tempfile.mkstemp(suffix='.gif')
+            os.close(fd)
+            target = unoptimized
+            layer_args = []
+        else:
+            target = str(output_path)
+            layer_args = ['-layers', 'optimize']
+
+        if pre_scaled:
+            geometry_args = []
+        else:
+            geometry_args = [
+                '-resize', f'{gif_width}x{gif_height}^',  # Fill to exact dimensions
+                '-gravity', 'center',  # Start from center
+                '-extent', f'{gif_width}x{gif_height}+0-{gif_height//18}',  # Shift up by 1/16 height
+            ]
+
         gif_cmd = [
             'convert',
             '-delay', str(gif_delay),
             '-loop', '0',
-            '-resize', f'{gif_width}x{gif_height}^',  # Fill to exact dimensions
-            '-gravity', 'center',  # Start from center
-            '-extent', f'{gif_width}x{gif_height}+0-{gif_height//18}',  # Shift up by 1/16 height
-            '-layers', 'optimize',
+            *geometry_args,
+            *layer_args,
             *photo_paths,
-            str(output_path)
+            target
         ]
-        
-        if logger:
-            logger.info(f"Creating GIF from {len(photo_paths)} original photos...")
-        
+
         result = subprocess.run(gif_cmd, capture_output=True, text=True)
-        
         if result.returncode != 0:
             if logger:
                 logger.error(f"GIF creation failed: {result.stderr}")
+            return False
+
+        if _GIFSICLE_PATH:
+            result = subprocess.run(
+                [_GIFSICLE_PATH, '-O3', '--lossy=80', '-o', str(output_path), unoptimized],
+                capture_output=True, text=True)
+            if result.returncode != 0:
+                if logger:
+                    logger.error(f"gifsicle optimization failed: {result.stderr}")
+                return False
+
+        return True
+    finally:
+        if unoptimized:
+            try:
+                os.unlink(unoptimized)
+            except OSError:
+                pass
+
+def _create_mp4_ffmpeg(photo_paths, output_path, gif_delay, gif_width, gif_height,
+                       logger, pre_scaled=False):
+    """Single-pass H.264 encode of the photo sequence.
+
+    MP4 is dramatically smaller than a GIF at the same quality, so the
+    too-big fallback to individual photos rarely triggers."""
+    duration = gif_delay / 100.0  # ImageMagick delay unit is 1/100 s
+    filters = 'null' if pre_scaled else _gif_filter_chain(gif_width, gif_height)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        list_path = os.path.join(tmp_dir, 'frames.txt')
+        with open(list_path, 'w') as f:
+            for path in photo_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+                f.write(f"duration {duration}\n")
+
+        cmd = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            # yuv420p needs even dimensions; pad the crop result if odd
+            '-vf', f'{filters},pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+            '-pix_fmt', 'yuv420p', '-movflags', '+faststart',
+            str(output_path)
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            if logger:
+                logger.error(f"ffmpeg mp4 encode failed: {result.stderr}")
+            return False
+
+    return True
+
+def timelapse_extension(config):
+    """File extension for the configured timelapse format"""
+    fmt = config.get('email_timelapse_format', 'gif').lower() if config else 'gif'
+    return 'mp4' if fmt == 'mp4' else 'gif'
+
+def create_timelapse(photo_paths, output_path, max_size_mb=20, config=None, logger=None):
+    """Create an animated timelapse (GIF, or MP4 when configured) from photos"""
+    if not photo_paths:
+        return None
+
+    try:
+        # Get timelapse settings from config or use defaults
+        gif_delay = int(config.get('gif_delay', '50')) if config else 50
+        gif_width = int(config.get('gif_width', '1920')) if config else 1920
+        gif_height = int(config.get('gif_height', '1080')) if config else 1080
+
+        fmt = timelapse_extension(config)
+        have_ffmpeg = shutil.which('ffmpeg')
+        if fmt == 'mp4' and not have_ffmpeg:
+            if logger:
+                logger.warning("MP4 timelapse requires ffmpeg, falling back to GIF")
+            fmt = 'gif'
+
+        if logger:
+            logger.info(f"Creating {fmt.upper()} from {len(photo_paths)} photos...")
+
+        # Reuse frames scaled by earlier runs; only new photos get scaled
+        scaled_paths = _prescale_photos(photo_paths, gif_width, gif_height, logger)
+        frames = scaled_paths if scaled_paths else photo_paths
+        pre_scaled = scaled_paths is not None
+
+        if fmt == 'mp4':
+            created = _create_mp4_ffmpeg(frames, output_path, gif_delay,
+                                         gif_width, gif_height, logger, pre_scaled)
+        elif have_ffmpeg:
+            created = _create_gif_ffmpeg(frames, output_path, gif_delay,
+                                         gif_width, gif_height, logger, pre_scaled)
+        else:
+            created = _create_gif_convert(frames, output_path, gif_delay,
+                                          gif_width, gif_height, logger, pre_scaled)
+        if not created:
             return None
-        
+
         # Check file size
         if output_path.exists():
             file_size_mb = output_path.stat().st_size / (1024 * 1024)
-            
+
             if logger:
-                logger.info(f"GIF created: {output_path.name} ({file_size_mb:.1f}MB)")
-            
-            # Return GIF path if under size limit, None if too big
+                logger.info(f"Timelapse created: {output_path.name} ({file_size_mb:.1f}MB)")
+
+            # Return timelapse path if under size limit, None if too big
             return str(output_path) if file_size_mb <= max_size_mb else None
-            
+
     except Exception as e:
         if logger:
-            logger.error(f"Error creating GIF: {e}")
+            logger.error(f"Error creating timelapse: {e}")
         return None
-    
+
     return None
 
+# Fixed banner text allocated once at import instead of per email
+_SYSTEM_INFO_HEADER = (
+    "\n═══════════════════════════════════════\n"
+    "           SYSTEM INFORMATION\n"
+    "═══════════════════════════════════════\n\n"
+    "Network Information:\n"
+    "   - Public IP:  {public_ip}\n"
+    "System Health:\n"
+    "   - CPU Temperature: {cpu_temperature}\n"
+    "   - CPU Usage:       {cpu_percent}\n"
+    "   - Memory Usage:    {memory_percent}\n"
+    "   - Disk Usage:      {disk_percent}\n"
+)
+_SYSTEM_INFO_DETAILS = (
+    "\nSystem Details:\n"
+    "   - Hostname:   {hostname}\n"
+    "   - Platform:   {platform}\n"
+    "   - Boot Time:  {boot_time}\n"
+    "   - Uptime:     {uptime}\n\n"
+)
+_SYSTEM_INFO_FOOTER = "═══════════════════════════════════════\n"
+
 def create_system_info_text(stats):
     """Create formatted system information"""
-    info = "\n═══════════════════════════════════════\n"
-    info += "           SYSTEM INFORMATION\n"
-    info += "═══════════════════════════════════════\n\n"
-    
-    info += "Network Information:\n"
-    info += f"   - Public IP:  {stats.get('public_ip', 'Unknown')}\n"
-    
-    info += "System Health:\n"
-    info += f"   - CPU Temperature: {stats.get('cpu_temperature', 'Unknown')}\n"
-    info += f"   - CPU Usage:       {stats.get('cpu_percent', 'Unknown')}\n"
-    info += f"   - Memory Usage:    {stats.get('memory_percent', 'Unknown')}\n"
-    info += f"   - Disk Usage:      {stats.get('disk_percent', 'Unknown')}\n\n"
-    
-    info += "System Details:\n"
-    info += f"   - Hostname:   {stats.get('hostname', 'Unknown')}\n"
-    info += f"   - Platform:   {stats.get('platform', 'Unknown')}\n"
-    info += f"   - Boot Time:  {stats.get('boot_time', 'Unknown')}\n"
-    info += f"   - Uptime:     {stats.get('uptime', 'Unknown')}\n\n"
-    
+    parts = [_SYSTEM_INFO_HEADER.format(
+        public_ip=stats.get('public_ip', 'Unknown'),
+        cpu_temperature=stats.get('cpu_temperature', 'Unknown'),
+        cpu_percent=stats.get('cpu_percent', 'Unknown'),
+        memory_percent=stats.get('memory_percent', 'Unknown'),
+        disk_percent=stats.get('disk_percent', 'Unknown'))]
+
+    # Present only when the photos dir lives on its own filesystem
+    if stats.get('photos_disk_percent'):
+        parts.append(f"   - Photos Disk:     {stats['photos_disk_percent']}\n")
+
+    parts.append(_SYSTEM_INFO_DETAILS.format(
+        hostname=stats.get('hostname', 'Unknown'),
+        platform=stats.get('platform', 'Unknown'),
+        boot_time=stats.get('boot_time', 'Unknown'),
+        uptime=stats.get('uptime', 'Unknown')))
+
     if stats.get('network_interfaces'):
-        info += "Network Interfaces:\n"
-        for interface in stats.get('network_interfaces', []):
-            info += f"   - {interface}\n"
-        info += "\n"
-    
-    info += "═══════════════════════════════════════\n"
-    return info
+        parts.append("Network Interfaces:\n")
+        parts.extend(f"   - {interface}\n"
+                     for interface in stats.get('network_interfaces', []))
+        parts.append("\n")
+
+    parts.append(_SYSTEM_INFO_FOOTER)
+    return ''.join(parts)
 
 def attach_photo(msg, photo_path, logger):
     """Attach a photo to email with error handling"""
@@ -284,22 +762,27 @@ def attach_photo(msg, photo_path, logger):
             logger.warning(f"Photo is empty: {photo_path}")
             return False
         
-        # Determine MIME type
+        # Determine MIME type (MP4 timelapses ride through here too)
         mime_type, _ = mimetypes.guess_type(photo_path)
-        if mime_type is None or not mime_type.startswith('image/'):
+        if mime_type is None or mime_type.split('/')[0] not in ('image', 'video'):
             mime_type = 'image/jpeg'
-        
+
         main_type, sub_type = mime_type.split('/', 1)
-        
-        # Read and attach
-        with open(photo_path, 'rb') as f:
-            img_data = f.read()
-        
-        image = MIMEImage(img_data, _subtype=sub_type)
+
+        # Map the file read-only and let the content manager base64
+        # encode straight from the page cache, skipping the read() copy
+        # of the whole image into the Python heap
         filename = os.path.basename(photo_path)
-        image.add_header('Content-Disposition', f'attachment; filename="{filename}"')
-        
-        msg.attach(image)
+        with open(photo_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mapped:
+                # memoryview because the content manager dispatches on
+                # exact type and does not know mmap objects
+                img_data = memoryview(mapped)
+                try:
+                    msg.add_attachment(img_data, maintype=main_type,
+                                       subtype=sub_type, filename=filename)
+                finally:
+                    img_data.release()
         logger.info(f"Attached: {filename} ({file_size} bytes)")
         return True
         
@@ -307,191 +790,441 @@ def attach_photo(msg, photo_path, logger):
         logger.error(f"Error attaching {photo_path}: {e}")
         return False
 
+def _encode_photo(photo_path):
+    """Read and base64-encode one photo; runs in a pool worker process"""
+    mime_type, _ = mimetypes.guess_type(photo_path)
+    if mime_type is None or not mime_type.startswith('image/'):
+        mime_type = 'image/jpeg'
+    sub_type = mime_type.split('/', 1)[1]
+
+    file_size = os.path.getsize(photo_path)
+    with open(photo_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mapped:
+            payload = base64.encodebytes(mapped)
+
+    return os.path.basename(photo_path), sub_type, payload, file_size
+
+def _attach_encoded(msg, filename, sub_type, payload):
+    """Attach an already base64-encoded payload without re-encoding it"""
+    from email.message import MIMEPart
+
+    part = MIMEPart()
+    part.add_header('Content-Type', f'image/{sub_type}', name=filename)
+    part.add_header('Content-Transfer-Encoding', 'base64')
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    part.set_payload(payload.decode('ascii'))
+
+    if msg.get_content_maintype() != 'multipart':
+        msg.make_mixed()
+    msg.attach(part)
+
+def attach_photos(msg, photo_paths, logger, cache=None):
+    """Attach a batch of photos, encoding across CPU cores when it pays off
+
+    base64 of a day's worth of JPEGs is pure CPU, so batches fan out to a
+    ProcessPoolExecutor; the cheap cases stay on the serial path. A cache
+    dict (photo path -> encoded part) can be passed in so photos already
+    encoded by an earlier call are not read and encoded again."""
+    if cache is None:
+        cache = {}
+
+    to_encode = [p for p in photo_paths if p not in cache]
+    if len(to_encode) <= 1 or (os.cpu_count() or 1) == 1:
+        for photo_path in to_encode:
+            try:
+                cache[photo_path] = _encode_photo(photo_path)
+            except Exception as e:
+                logger.error(f"Error attaching {photo_path}: {e}")
+                cache[photo_path] = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor() as executor:
+            future_by_path = {p: executor.submit(_encode_photo, p) for p in to_encode}
+            for photo_path in to_encode:
+                try:
+                    cache[photo_path] = future_by_path[photo_path].result()
+                except Exception as e:
+                    logger.error(f"Error attaching {photo_path}: {e}")
+                    cache[photo_path] = None
+
+    attached_count = 0
+    for photo_path in photo_paths:  # keep attachment order stable
+        encoded = cache.get(photo_path)
+        if encoded is None:
+            continue
+        filename, sub_type, payload, file_size = encoded
+        _attach_encoded(msg, filename, sub_type, payload)
+        logger.info(f"Attached: {filename} ({file_size} bytes)")
+        attached_count += 1
+
+    return attached_count
+
+_ssl_context = None
+
+def _get_ssl_context():
+    """Default TLS context, built once so cert loading happens once"""
+    global _ssl_context
+    if _ssl_context is None:
+        import ssl
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+def _smtp_settings(config):
+    """Resolve server, port, TLS and local-relay handling from config"""
+    smtp_server = config.get('smtp_server', 'smtp.gmail.com')
+    smtp_port = int(config.get('smtp_port', '587'))
+    use_tls = config.get('use_tls', 'true').lower() == 'true'
+    # Implicit TLS (port 465) skips the EHLO/STARTTLS/EHLO exchange that
+    # the 587 upgrade path pays before the handshake
+    use_ssl = config.get('smtp_ssl', 'false').lower() == 'true'
+
+    # A local Postfix relay needs neither TLS nor AUTH; skipping both
+    # removes the handshake and login round-trips from every send
+    local_relay = smtp_server in ('localhost', '127.0.0.1', '::1')
+    if local_relay:
+        use_tls = False
+        use_ssl = False
+
+    return smtp_server, smtp_port, use_tls, use_ssl, local_relay
+
+def _connect_smtp(config):
+    """Open, upgrade and authenticate an smtplib connection"""
+    import smtplib
+
+    smtp_server, smtp_port, use_tls, use_ssl, local_relay = _smtp_settings(config)
+
+    if use_ssl:
+        server = smtplib.SMTP_SSL(smtp_server, smtp_port,
+                                  context=_get_ssl_context())
+    else:
+        server = smtplib.SMTP(smtp_server, smtp_port)
+        if use_tls:
+            server.starttls()
+    if not local_relay:
+        server.login(config['sender_email'], config['sender_password'])
+    return server
+
+def _get_aiosmtplib():
+    """The aiosmtplib module when installed, else None (smtplib is used)"""
+    try:
+        import aiosmtplib
+        return aiosmtplib
+    except ImportError:
+        return None
+
+def _smtp_alive(server, logger):
+    """True if an idle smtplib connection still answers NOOP.
+
+    A dead one is closed and reported so the caller can reconnect."""
+    try:
+        server.noop()
+        return True
+    except Exception:
+        logger.info("SMTP connection lost, reconnecting")
+        try:
+            server.close()
+        except Exception:
+            pass
+        return False
+
+def deliver_message(config, raw, recipients, logger, server=None):
+    """Deliver pre-serialized message bytes over SMTP, preferring
+    aiosmtplib when installed.
+
+    On the smtplib path the caller owns the connection: pass one from
+    _connect_smtp and only the send itself happens here, so a failed
+    sendmail leaves the authenticated connection in the caller's hands
+    for the next attempt. Returns the connection (None on the async
+    path, which opens a fresh connection per send)."""
+    aiosmtplib = _get_aiosmtplib()
+
+    if aiosmtplib is not None:
+        import asyncio
+        smtp_server, smtp_port, use_tls, use_ssl, local_relay = _smtp_settings(config)
+
+        # Async path: TLS handshake and delivery run on one non-blocking
+        # connection, so a slow recipient list doesn't serialize on RTTs
+        async def _send():
+            # start_tls is decided explicitly: aiosmtplib's default (None)
+            # would auto-upgrade whenever the server advertises STARTTLS,
+            # breaking a second manual starttls() and ignoring USE_TLS=false
+            smtp = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port,
+                                   use_tls=use_ssl,
+                                   start_tls=(use_tls and not use_ssl))
+            await smtp.connect()
+            if not local_relay:
+                await smtp.login(config['sender_email'], config['sender_password'])
+            await smtp.sendmail(config['sender_email'], recipients, raw)
+            await smtp.quit()
+
+        asyncio.run(_send())
+        logger.info(f"Email sent successfully to {len(recipients)} recipients")
+        return None
+
+    if server is None:
+        server = _connect_smtp(config)
+
+    server.sendmail(config['sender_email'], recipients, raw)
+    logger.info(f"Email sent successfully to {len(recipients)} recipients")
+    return server
+
+# Capture time lives in the filename: watchpot_20250809_0800.jpg -> 08:00
+_PHOTO_TIME_RE = re.compile(r'watchpot_\d{8}_(\d{2})(\d{2})\.jpg$')
+
+def _format_subject(config, timestamp, today_date, logger):
+    """Render the subject template, falling back on a bad placeholder"""
+    subject = config.get('email_subject', 'WatchPot Daily Report - {date}')
+    try:
+        return subject.format(date=today_date, timestamp=timestamp)
+    except KeyError as e:
+        logger.warning(f"Template formatting error in subject: {e}")
+        return f"WatchPot Daily Report - {today_date}"
+
+def _format_body(config, photo_paths, timestamp, today_date, logger):
+    """Render the body template, falling back on a bad placeholder"""
+    if not photo_paths:
+        logger.warning("No photos found for today")
+        return "Hello!\n\nNo photos were captured today. Please check the system.\n\nSystem information below."
+
+    capture_times = []
+    for photo_path in photo_paths:
+        match = _PHOTO_TIME_RE.search(os.path.basename(photo_path))
+        if match:
+            capture_times.append(f"{match.group(1)}:{match.group(2)}")
+
+    body_template = config.get('email_body',
+        'Hello! WatchPot captured {count} photos today at {times}. System info below.')
+    try:
+        return body_template.format(
+            count=len(photo_paths),
+            times=', '.join(capture_times) if capture_times else 'various times',
+            timestamp=timestamp,
+            date=today_date
+        )
+    except KeyError as e:
+        logger.warning(f"Template formatting error in body: {e}")
+        return f"Hello! WatchPot captured {len(photo_paths)} photos today. System info below."
+
+def _close_smtp(server):
+    """Politely close an smtplib connection, ignoring a dead socket"""
+    if server is None:
+        return
+    try:
+        server.quit()
+    except Exception:
+        pass
+
+# base64 expands payloads by 4/3 plus line breaks and MIME headers
+_BASE64_OVERHEAD = 1.37
+
+def _fit_attachment_budget(photo_paths, max_bytes, logger):
+    """Trim the photo list so its encoded size stays under the cap.
+
+    Providers reject oversized messages only after the whole upload
+    (Gmail at ~25MB), so exceeding the cap wastes the entire transfer.
+    Keeps the most recent photos that fit; in incremental mode the
+    dropped ones simply go out with a later email."""
+    sizes = []
+    for path in photo_paths:
+        try:
+            sizes.append(os.path.getsize(path))
+        except OSError:
+            sizes.append(0)
+
+    if sum(sizes) * _BASE64_OVERHEAD <= max_bytes:
+        return photo_paths
+
+    kept = []
+    budget = max_bytes / _BASE64_OVERHEAD
+    for path, size in zip(reversed(photo_paths), reversed(sizes)):
+        if size <= budget:
+            kept.append(path)
+            budget -= size
+    kept.reverse()
+
+    logger.warning(f"Attachments would exceed {max_bytes / (1024 * 1024):.0f}MB "
+                   f"limit, keeping {len(kept)} of {len(photo_paths)} photos")
+    return kept
+
+def _build_message(config, daily_dir, today, photo_paths, attach_paths,
+                   subject, body, encoded_photos, logger):
+    """Assemble the MIME message: headers, body and photo attachments"""
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg['From'] = config['sender_email']
+    msg['To'] = config['recipients']
+    msg['Subject'] = subject
+    msg.set_content(body)
+
+    # Handle photo attachments - GIF or individual photos
+    attached_count = 0
+    create_gif = config.get('email_create_gif', 'false').lower() == 'true'
+
+    if photo_paths and create_gif:
+        # Try to create a timelapse (GIF or MP4) from original photos
+        gif_max_size = float(config.get('email_gif_max_size_mb', '20'))
+        ext = timelapse_extension(config)
+        gif_path = daily_dir / f"watchpot_timelapse_{today.strftime('%Y%m%d')}.{ext}"
+
+        gif_file = create_timelapse(photo_paths, gif_path, gif_max_size, config, logger)
+
+        if gif_file and attach_photo(msg, gif_file, logger):
+            attached_count = 1
+            logger.info(f"Attached timelapse with {len(photo_paths)} photos")
+
+            # Optionally attach a single high-res photo along with GIF
+            attach_single = config.get('email_attach_single_photo', 'false').lower() == 'true'
+            if attach_single:
+                selection_method = config.get('email_single_photo_selection', 'last')
+                single_photo = select_single_photo(photo_paths, selection_method)
+                if single_photo and attach_photo(msg, single_photo, logger):
+                    attached_count += 1
+                    logger.info(f"Attached single high-res photo ({selection_method}): {os.path.basename(single_photo)}")
+        else:
+            # Timelapse failed or too big - send individual photos
+            if gif_file is None:
+                logger.warning("Timelapse creation failed, sending individual photos")
+            else:
+                logger.warning("Timelapse too large, sending individual photos instead")
+
+            attached_count = attach_photos(msg, attach_paths, logger, encoded_photos)
+    else:
+        # Attach individual photos
+        attached_count = attach_photos(msg, attach_paths, logger, encoded_photos)
+
+    # Log attachment summary
+    if create_gif and attached_count >= 1:
+        attach_single = config.get('email_attach_single_photo', 'false').lower() == 'true'
+        if attach_single and attached_count == 2:
+            logger.info(f"Attached {attached_count} files: GIF + 1 high-res photo")
+        else:
+            logger.info(f"Attached {attached_count} file(s): GIF")
+    else:
+        logger.info(f"Attached {attached_count} individual photos")
+
+    return msg
+
 def send_daily_email(config, logger):
     """Send email with retry logic"""
     max_retries = int(config.get('max_retries', '3'))
     retry_delay = int(config.get('retry_delay', '30'))
-    
+
+    # The smtplib connection is owned by this loop: connected lazily,
+    # probed with NOOP before reuse, and kept across a failed sendmail so
+    # a retry repeats only the DATA upload, not TCP, TLS and AUTH. Stays
+    # None on the aiosmtplib path, which connects per send.
+    smtp_conn = None
+
+    # Everything deterministic happens once, before the retry loop: photo
+    # scan, system stats, template rendering, MIME assembly and
+    # serialization produce the same result on every attempt, so retries
+    # resend the same bytes and pay only for the send itself. Guarded like
+    # the loop body: a bad config or unreadable photo logs and fails
+    # instead of escaping to main() as a raw traceback
+    try:
+        now = datetime.datetime.now()
+        today = now.date()
+        daily_dir = daily_dir_for(config.get('photos_dir', 'photos'), today)
+        incremental = config.get('email_incremental_photos', 'false').lower() == 'true'
+        photo_paths = get_photos_to_send(daily_dir, incremental)
+
+        logger.info(f"Found {len(photo_paths)} photos to send {'(incremental)' if incremental else '(all)'}")
+
+        stats = get_system_stats(config, now)
+
+        timestamp = stats.get('timestamp', now.strftime('%Y-%m-%d %H:%M:%S'))
+        today_date = today.strftime('%Y-%m-%d')
+        subject = _format_subject(config, timestamp, today_date, logger)
+        body = _format_body(config, photo_paths, timestamp, today_date, logger)
+        body += create_system_info_text(stats)
+
+        # Individual attachments are capped below the provider's message
+        # size limit; the timelapse path keeps its own email_gif_max_size_mb
+        # cap
+        try:
+            max_attach_mb = float(config.get('email_max_attach_mb', '24'))
+        except ValueError:
+            max_attach_mb = 24.0
+        attach_paths = _fit_attachment_budget(
+            photo_paths, int(max_attach_mb * 1024 * 1024), logger)
+
+        msg = _build_message(config, daily_dir, today, photo_paths, attach_paths,
+                             subject, body, {}, logger)
+        from email import policy
+        from email.generator import BytesGenerator
+        buf = io.BytesIO()
+        BytesGenerator(buf, policy=policy.SMTP).flatten(msg)
+        raw = buf.getvalue()
+
+        recipients = config.get('_recipients') or _parse_recipients(config['recipients'])
+    except Exception as e:
+        logger.error(f"Error preparing email: {e}")
+        return False
+
     for attempt in range(max_retries):
         try:
             logger.info(f"Email attempt {attempt + 1}/{max_retries}")
-            
-            # Get today's photos (incremental or all)
-            photos_dir = config.get('photos_dir', 'photos')
-            incremental = config.get('email_incremental_photos', 'false').lower() == 'true'
-            photo_paths = get_photos_to_send(photos_dir, incremental)
-            
-            logger.info(f"Found {len(photo_paths)} photos to send {'(incremental)' if incremental else '(all)'}")
-            
-            # Get system stats
-            stats = get_system_stats()
-            
-            # Create email
-            msg = MIMEMultipart('mixed')
-            msg['From'] = config['sender_email']
-            msg['To'] = config['recipients']
-            
-            # Subject
-            timestamp = stats.get('timestamp', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-            today_date = datetime.date.today().strftime('%Y-%m-%d')
-            subject = config.get('email_subject', 'WatchPot Daily Report - {date}')
-            try:
-                subject = subject.format(date=today_date, timestamp=timestamp)
-            except KeyError as e:
-                logger.warning(f"Template formatting error in subject: {e}")
-                subject = f"WatchPot Daily Report - {today_date}"
-            msg['Subject'] = subject
-            
-            # Body
-            if photo_paths:
-                capture_times = []
-                for photo_path in photo_paths:
-                    filename = os.path.basename(photo_path)
-                    try:
-                        # Extract time from filename like watchpot_20250809_0800.jpg
-                        parts = filename.replace('.jpg', '').split('_')
-                        if len(parts) >= 3:
-                            time_str = parts[2]
-                            if len(time_str) == 4:  # HHMM
-                                formatted_time = f"{time_str[:2]}:{time_str[2:]}"
-                                capture_times.append(formatted_time)
-                    except:
-                        pass
-                
-                body_template = config.get('email_body', 
-                    'Hello! WatchPot captured {count} photos today at {times}. System info below.')
-                try:
-                    body = body_template.format(
-                        count=len(photo_paths),
-                        times=', '.join(capture_times) if capture_times else 'various times',
-                        timestamp=timestamp,
-                        date=today_date
-                    )
-                except KeyError as e:
-                    logger.warning(f"Template formatting error in body: {e}")
-                    body = f"Hello! WatchPot captured {len(photo_paths)} photos today. System info below."
-            else:
-                body = "Hello!\n\nNo photos were captured today. Please check the system.\n\nSystem information below."
-                logger.warning("No photos found for today")
-            
-            # Add system info
-            body += create_system_info_text(stats)
-            
-            # Attach body
-            text_part = MIMEText(body, 'plain', 'utf-8')
-            msg.attach(text_part)
-            
-            # Handle photo attachments - GIF or individual photos
-            attached_count = 0
-            create_gif = config.get('email_create_gif', 'false').lower() == 'true'
-            
-            if photo_paths and create_gif:
-                # Try to create GIF from original photos
-                gif_max_size = float(config.get('email_gif_max_size_mb', '20'))
-                today = datetime.date.today()
-                daily_dir = Path(photos_dir) / f"daily_{today.strftime('%Y%m%d')}"
-                gif_path = daily_dir / f"watchpot_timelapse_{today.strftime('%Y%m%d')}.gif"
-                
-                gif_file = create_gif_from_photos(photo_paths, gif_path, gif_max_size, config, logger)
-                
-                if gif_file and attach_photo(msg, gif_file, logger):
-                    attached_count = 1
-                    logger.info(f"Attached GIF with {len(photo_paths)} photos")
-                    
-                    # Optionally attach a single high-res photo along with GIF
-                    attach_single_raw = config.get('email_attach_single_photo', 'false')
-                    attach_single = attach_single_raw.split('#')[0].strip().lower() == 'true'
-                    if attach_single:
-                        selection_method_raw = config.get('email_single_photo_selection', 'last')
-                        selection_method = selection_method_raw.split('#')[0].strip()
-                        single_photo = select_single_photo(photo_paths, selection_method)
-                        if single_photo and attach_photo(msg, single_photo, logger):
-                            attached_count += 1
-                            logger.info(f"Attached single high-res photo ({selection_method}): {os.path.basename(single_photo)}")
-                else:
-                    # GIF failed or too big - send individual photos
-                    if gif_file is None:
-                        logger.warning("GIF creation failed, sending individual photos")
-                    else:
-                        logger.warning("GIF too large, sending individual photos instead")
-                    
-                    for photo_path in photo_paths:
-                        if attach_photo(msg, photo_path, logger):
-                            attached_count += 1
-            else:
-                # Attach individual photos
-                for photo_path in photo_paths:
-                    if attach_photo(msg, photo_path, logger):
-                        attached_count += 1
-            
-            # Log attachment summary
-            if create_gif and attached_count >= 1:
-                attach_single = config.get('email_attach_single_photo', 'false').lower() == 'true'
-                if attach_single and attached_count == 2:
-                    logger.info(f"Attached {attached_count} files: GIF + 1 high-res photo")
-                else:
-                    logger.info(f"Attached {attached_count} file(s): GIF")
-            else:
-                logger.info(f"Attached {attached_count} individual photos")
-            
-            # Send email
-            smtp_server = config.get('smtp_server', 'smtp.gmail.com')
-            smtp_port = int(config.get('smtp_port', '587'))
-            use_tls = config.get('use_tls', 'true').lower() == 'true'
-            
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                if use_tls:
-                    server.starttls()
-                
-                server.login(config['sender_email'], config['sender_password'])
-                
-                recipients = [r.strip() for r in config['recipients'].split(',')]
-                server.send_message(msg, to_addrs=recipients)
-                
-                logger.info(f"Email sent successfully to {len(recipients)} recipients")
-                
-                # Update sent photos list for incremental sending
-                if incremental and photo_paths:
-                    sent_photos = load_sent_photos(photos_dir)
-                    new_sent = sent_photos + [os.path.basename(p) for p in photo_paths]
-                    save_sent_photos(photos_dir, new_sent)
-                    logger.info(f"Updated sent photos list: {len(new_sent)} total")
-                
-                return True
-                
+
+            if _get_aiosmtplib() is None:
+                if smtp_conn is not None and not _smtp_alive(smtp_conn, logger):
+                    smtp_conn = None
+                if smtp_conn is None:
+                    smtp_conn = _connect_smtp(config)
+
+            smtp_conn = deliver_message(config, raw, recipients, logger, smtp_conn)
+
+            # Update sent photos list for incremental sending; photos
+            # dropped by the size cap stay unsent for the next run
+            if incremental and attach_paths:
+                sent_photos = load_sent_photos(daily_dir)
+                sent_photos |= {os.path.basename(p) for p in attach_paths}
+                save_sent_photos(daily_dir, sent_photos)
+                logger.info(f"Updated sent photos list: {len(sent_photos)} total")
+
+            _close_smtp(smtp_conn)
+            return True
+
         except Exception as e:
             logger.warning(f"Email attempt {attempt + 1} failed: {e}")
             if attempt < max_retries - 1:
                 logger.info(f"Retrying in {retry_delay} seconds...")
                 time.sleep(retry_delay)
-    
+
+    _close_smtp(smtp_conn)
     logger.error(f"Failed to send email after {max_retries} attempts")
     return False
 
-def should_send_now(config):
-    """Check if we should send email now based on schedule"""
-    email_times = config.get('email_time', '19:00').split(',')
-    current_dt = datetime.datetime.now()
-    
-    # Allow 10 minutes window for each scheduled time
-    for scheduled_time in email_times:
+def build_send_lookup(email_times, window_minutes=5):
+    """Map each minute of day inside a send window to True"""
+    lookup = {}
+    for scheduled_time in email_times.split(','):
         scheduled_time = scheduled_time.strip()
         if not scheduled_time:
             continue
-            
+
         try:
             hour, minute = map(int, scheduled_time.split(':'))
-            scheduled_dt = current_dt.replace(hour=hour, minute=minute, second=0, microsecond=0)
-            
-            # Check if current time is within 10 minutes of scheduled time
-            time_diff = abs((current_dt - scheduled_dt).total_seconds())
-            if time_diff <= 301:  # 5 minutes window
-                return True
-                
         except ValueError:
             continue
-    
-    return False
+
+        base = hour * 60 + minute
+        for delta in range(-window_minutes, window_minutes + 1):
+            lookup[(base + delta) % 1440] = True
+
+    return lookup
+
+def should_send_now(config):
+    """Check if we should send email now based on schedule"""
+    lookup = config.get('_email_minutes')
+    if lookup is None:
+        lookup = build_send_lookup(config.get('email_time', '19:00'))
+
+    # The 5-minute windows are baked into the lookup, so the check is a
+    # single dict probe instead of per-entry datetime arithmetic
+    now = datetime.datetime.now()
+    return (now.hour * 60 + now.minute) in lookup
 
 def main():
     import argparse